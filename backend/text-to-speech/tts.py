@@ -29,16 +29,25 @@ Author: Neural Speak Team
 Version: 1.0.0
 """
 
-import io
+import json
 import os
+import struct
 import sys
-from typing import Optional
+import threading
+from typing import Iterator, Literal, Optional
 import uuid
 
+from fastapi.responses import StreamingResponse
 import modal
 from pydantic import BaseModel
-import torch 
-import torchaudio
+from starlette.background import BackgroundTask
+
+# Load CUDA kernel modules lazily so container startup doesn't pay for
+# kernels that are never launched (must be set before the CUDA context
+# is created, i.e. before any CUDA work in torch)
+os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
+
+import torch
 
 # =============================================================================
 # MODAL APPLICATION CONFIGURATION
@@ -47,19 +56,35 @@ import torchaudio
 # Initialize Modal application with unique identifier
 app = modal.App("neural-speak-sufjan")
 
+def download_chatterbox() -> None:
+    """
+    Populate the Hugging Face cache with Chatterbox weights at image build.
+
+    Runs during the image build (see .run_function below) so the weights
+    live in an image layer on fast local SSD instead of being downloaded
+    from the Hugging Face hub on container start.
+    """
+    from chatterbox.mtl_tts import ChatterboxMultilingualTTS
+    ChatterboxMultilingualTTS.from_pretrained(device="cpu")
+
+
 # Define the container image with all required dependencies
 # Uses Debian slim for minimal footprint with Python 3.11
 image = (
     modal.Image.debian_slim(python_version="3.11")
     .pip_install("numpy==1.26.0", "torch==2.6.0")
     .pip_install_from_requirements("requirements.txt")
-    .apt_install("ffmpeg")  # Required for audio format conversion
+    # Required to decode non-WAV voice prompts: uploads accept any audio/*
+    # type and librosa's audioread fallback needs ffmpeg for mp3/m4a/webm
+    .apt_install("ffmpeg")
+    .env({
+        "CUDA_MODULE_LOADING": "LAZY",    # Load only the CUDA kernels actually launched
+        "OMP_NUM_THREADS": "1",           # Avoid CPU thread thrash when ops fall back to CPU
+        "TOKENIZERS_PARALLELISM": "false",  # No tokenizer fork workers in a server process
+    })
+    .run_function(download_chatterbox)  # Bake model weights into the image layer
 )
 
-# Persistent volume for caching Hugging Face model weights
-# Reduces cold start time by preserving downloaded models between invocations
-volume = modal.Volume.from_name("hf-cache-neural-speak", create_if_missing=True)
-
 # AWS S3 credentials for audio file storage
 s3_secret = modal.Secret.from_name("neural-speak-aws-secret")
 
@@ -82,12 +107,17 @@ class TextToSpeechRequest(BaseModel):
                       Higher values produce more expressive output.
         cfg_weight: Classifier-free guidance weight affecting speech pacing.
                     Lower values = faster speech, higher = more deliberate.
+        format: Output encoding - 'wav' (default) stores a playable WAV file,
+                'pcm' stores raw little-endian int16 samples plus a JSON
+                sidecar, skipping the WAV container for clients that decode
+                to PCM anyway (e.g. WebAudio).
     """
     text: str
     voice_s3_key: Optional[str] = None
     language: str = "en"
     exaggeration: float = 0.5
     cfg_weight: float = 0.5
+    format: Literal["wav", "pcm"] = "wav"
 
 
 class TextToSpeechResponse(BaseModel):
@@ -96,9 +126,13 @@ class TextToSpeechResponse(BaseModel):
     
     Attributes:
         s3_Key: The S3 object key where the generated audio file is stored.
-                Format: 'tts/{uuid}.wav'
+                Format: 'tts/{uuid}.wav' (or 'tts/{uuid}.pcm' for raw output).
+        sample_rate: Sample rate of the generated audio in Hz.
+        num_samples: Number of samples in the generated audio.
     """
     s3_Key: str
+    sample_rate: int
+    num_samples: int
 
 
 # =============================================================================
@@ -109,12 +143,13 @@ class TextToSpeechResponse(BaseModel):
     image=image,
     gpu="L40S",  # NVIDIA L40S GPU for fast inference
     volumes={
-        "/root/.cache/huppingface": volume,  # Model cache mount
         "/s3-mount": modal.CloudBucketMount("neural-speak-sufjan", secret=s3_secret)
     },
-    scaledown_window=120,  # Keep warm for 2 minutes after last request
+    min_containers=1,  # Always keep one container warm so no user pays the model-load cost
+    scaledown_window=600,  # Keep extra containers warm for 10 minutes after last request
     secrets=[s3_secret]
 )
+@modal.concurrent(max_inputs=4)  # Let one warm container absorb concurrent requests
 class TextToSpeechServer:
     """
     Serverless TTS generation service powered by Chatterbox multilingual model.
@@ -127,7 +162,11 @@ class TextToSpeechServer:
         load_model: Lifecycle hook that initializes the TTS model on startup.
         generate_speech: FastAPI endpoint that processes TTS requests.
     """
-    
+
+    # Maximum number of cached voice-prompt encodings; each entry is a small
+    # set of conditioning tensors, so this keeps GPU memory growth bounded
+    VOICE_CACHE_MAX_ENTRIES = 64
+
     @modal.enter()
     def load_model(self) -> None:
         """
@@ -140,6 +179,60 @@ class TextToSpeechServer:
         from chatterbox.mtl_tts import ChatterboxMultilingualTTS
         self.model = ChatterboxMultilingualTTS.from_pretrained(device="cuda")
 
+        # Compile the flow-matching estimator, the per-step module of the
+        # ODE loop (one forward per Euler step, many small kernels each), so
+        # its captured CUDA graph replays without per-step Python and
+        # kernel-launch overhead. Chatterbox's solve_euler invokes
+        # estimator.forward(...) directly, bypassing __call__, so neither
+        # torch.compile(module) nor nn.Module.compile() would ever be
+        # dispatched - the bound forward itself has to be wrapped.
+        #
+        # The T3 token loop is deliberately left eager: T3.inference builds a
+        # fresh alignment analyzer per call, registering new attention hooks
+        # each request, which under dynamo either don't fire inside captured
+        # regions (breaking EOS enforcement) or force a recompile per
+        # request. Compiling that backbone needs on-GPU validation first.
+        # The voice encoder also stays eager: it runs once per voice, not
+        # per step, and its results are cached across requests anyway.
+        estimator = getattr(
+            getattr(getattr(self.model.s3gen, "flow", None), "decoder", None),
+            "estimator", None)
+        if isinstance(estimator, torch.nn.Module):
+            estimator.forward = torch.compile(estimator.forward, backend="cudagraphs")
+
+        # Trigger compilation, graph capture, and cuDNN algorithm selection
+        # now, at container startup, so the first user request doesn't pay
+        # for it. Two passes with different lengths let dynamic-shape
+        # recompiles settle. cuDNN benchmarking is enabled only for the
+        # warmup: production input sizes vary per request, so leaving it on
+        # would re-benchmark on every new shape.
+        torch.backends.cudnn.benchmark = True
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+            for warmup_text in ("Warming up.", "Warming up the compiled decoder modules."):
+                self.model.generate(warmup_text, language_id="en")
+        torch.backends.cudnn.benchmark = False
+
+        # Voice-conditioning cache: encoding a voice prompt costs an S3 FUSE
+        # read plus a voice-encoder forward, but the result depends only on
+        # the prompt file, so encodings are reused across requests. The
+        # built-in voice is kept aside so default-voice requests never
+        # inherit a previously cloned voice.
+        self._voice_conds = {}
+        self._default_conds = self.model.conds
+
+        # The voice conditioning travels to generate() through the model's
+        # mutable conds attribute, so with @modal.concurrent the
+        # set-conds-then-generate sequence must not interleave across
+        # request threads or audio comes out in the wrong voice. The lock
+        # covers synthesis plus, on a cache miss, the prompt read and
+        # voice-encoder forward (prepare_conditionals also writes conds);
+        # the WAV encode and output write of concurrent requests overlap.
+        self._generate_lock = threading.Lock()
+
+        # Create the output prefix on the S3 mount once; doing it per
+        # request cost a network round-trip over FUSE every call
+        os.makedirs("/s3-mount/tts", exist_ok=True)
+
     @modal.fastapi_endpoint(method="POST", requires_proxy_auth=True)
     def generate_speech(self, request: TextToSpeechRequest) -> TextToSpeechResponse:
         """
@@ -158,57 +251,226 @@ class TextToSpeechServer:
         Raises:
             FileNotFoundError: If the specified voice prompt file doesn't exist in S3.
         """
-        # Generate speech with gradient computation disabled for inference efficiency
-        with torch.no_grad():
-            if request.voice_s3_key:
-                # Voice cloning mode: use provided audio sample as voice reference
-                audio_prompt_path = f"/s3-mount/{request.voice_s3_key}"
-
-                if not os.path.exists(audio_prompt_path):
-                    raise FileNotFoundError(
-                        f"Prompt audio not found at {audio_prompt_path}")
-                
-                wav = self.model.generate(
-                    request.text, 
-                    audio_prompt_path=audio_prompt_path,
-                    language_id=request.language,
-                    exaggeration=request.exaggeration,
-                    cfg_weight=request.cfg_weight
-                )
-            else:
-                # Default voice mode: use model's built-in voice
+        wav_cpu = self._synthesize(request)
+        num_samples = wav_cpu.shape[1]
+
+        # Generate unique filename and construct S3 path
+        audio_uuid = uuid.uuid4().hex
+
+        if request.format == "pcm":
+            # Raw output: little-endian int16 samples with a JSON sidecar, so
+            # PCM-decoding clients skip the WAV container and ~save a third
+            # of the stored bytes; playback metadata also rides the response
+            s3_key = f"tts/{audio_uuid}.pcm"
+            pcm = (wav_cpu.reshape(-1).clamp(-1.0, 1.0) * 32767.0).to(torch.int16)
+            pcm.numpy().tofile(f"/s3-mount/{s3_key}")
+            with open(f"/s3-mount/tts/{audio_uuid}.json", "w") as f:
+                json.dump({"sample_rate": self.model.sr, "num_samples": num_samples}, f)
+        else:
+            # Encode WAV straight onto the mounted bucket; routing through an
+            # in-memory buffer first copied the full waveform two extra times
+            s3_key = f"tts/{audio_uuid}.wav"
+            self._write_wav(f"/s3-mount/{s3_key}", wav_cpu, self.model.sr)
+
+        print(f"Saved audio to S3: {s3_key}")
+        return TextToSpeechResponse(
+            s3_Key=s3_key,
+            sample_rate=self.model.sr,
+            num_samples=num_samples,
+        )
+
+    @modal.fastapi_endpoint(method="POST", requires_proxy_auth=True)
+    def stream_speech(self, request: TextToSpeechRequest) -> StreamingResponse:
+        """
+        Stream generated speech to the client as WAV bytes.
+
+        Unlike generate_speech, which blocks until the audio has been written
+        to S3 and then hands the client a key to fetch, this endpoint sends
+        the waveform over the response body as soon as synthesis finishes and
+        persists to S3 afterwards, outside the user-visible path. Chatterbox
+        does not expose an incremental decode API, so synthesis itself is
+        still a single call; if one lands upstream this generator is the
+        place to consume it chunk by chunk.
+
+        Args:
+            request: TextToSpeechRequest containing text and generation parameters.
+
+        Returns:
+            StreamingResponse with audio/wav content. The S3 key the audio
+            will be persisted under is exposed in the X-S3-Key header.
+        """
+        audio_uuid = uuid.uuid4().hex
+        s3_key = f"tts/{audio_uuid}.wav"
+
+        wav_cpu = self._synthesize(request)
+        num_samples = wav_cpu.shape[1]
+        pcm = (wav_cpu.squeeze(0).clamp(-1.0, 1.0) * 32767.0).to(torch.int16)
+
+        def wav_chunks() -> Iterator[bytes]:
+            # 16-bit PCM in ~0.5 s chunks; the header goes out first so
+            # clients can begin decoding immediately
+            chunk_samples = max(self.model.sr // 2, 1)
+            yield self._wav_header(num_samples, self.model.sr)
+            for start in range(0, num_samples, chunk_samples):
+                yield pcm[start:start + chunk_samples].numpy().tobytes()
+
+        def persist_to_s3() -> None:
+            # The file is byte-identical to what was streamed, so reuse the
+            # converted samples
+            with open(f"/s3-mount/{s3_key}", "wb") as f:
+                f.write(self._wav_header(num_samples, self.model.sr))
+                pcm.numpy().tofile(f)
+            print(f"Saved audio to S3: {s3_key}")
+
+        # The upload runs as a background task once the response is done, so
+        # it never delays time-to-first-audio and still completes if the
+        # client disconnects mid-stream (the advertised X-S3-Key must end up
+        # pointing at a real object either way)
+        return StreamingResponse(
+            wav_chunks(),
+            media_type="audio/wav",
+            headers={"X-S3-Key": s3_key},
+            background=BackgroundTask(persist_to_s3),
+        )
+
+    def _synthesize(self, request: TextToSpeechRequest) -> torch.Tensor:
+        """
+        Run the model for a single request and return the finished waveform.
+
+        Shared by the buffered and streaming endpoints: runs generation under
+        inference mode and bfloat16 autocast, trims trailing silence, and
+        returns the retained audio as a (1, samples) fp32 CPU tensor (the
+        model hands the waveform back already on the host).
+
+        Args:
+            request: TextToSpeechRequest containing text and generation parameters.
+
+        Returns:
+            Trimmed audio tensor on the CPU, ready for encoding.
+
+        Raises:
+            FileNotFoundError: If the specified voice prompt file doesn't exist in S3.
+        """
+        # Generate speech in inference mode: unlike no_grad, this also disables
+        # view/version-counter tracking, shaving overhead off every decode step
+        with torch.inference_mode():
+            # Run the model under bfloat16 autocast: the L40S executes BF16
+            # matmuls on Tensor Cores at roughly twice FP32 throughput and
+            # halves weight-memory traffic for the memory-bound decode steps
+            with torch.autocast(device_type="cuda", dtype=torch.bfloat16), \
+                    self._generate_lock:
+                if request.voice_s3_key:
+                    # Voice cloning mode: condition on the provided audio
+                    # sample, reusing a cached encoding when available
+                    self._apply_voice_prompt(request.voice_s3_key, request.exaggeration)
+                else:
+                    # Default voice mode: use model's built-in voice
+                    self.model.conds = self._default_conds
+
                 wav = self.model.generate(
                     request.text,
                     language_id=request.language,
                     exaggeration=request.exaggeration,
                     cfg_weight=request.cfg_weight
                 )
-            
-            # Move tensor to CPU for file I/O operations
-            wav_cpu = wav.cpu()
-            
-            # Trim trailing silence/artifacts from the audio
-            wav_cpu = self._trim_trailing_silence(wav_cpu, self.model.sr)
 
-        # Convert the audio tensor to WAV format bytes using an in-memory buffer
-        buffer = io.BytesIO()
-        torchaudio.save(buffer, wav_cpu, self.model.sr, format="wav")
-        buffer.seek(0)  # Reset buffer position for reading
-        audio_bytes = buffer.read()
+            # Keep post-processing and the WAV encode in full precision
+            wav = wav.float()
 
-        # Generate unique filename and construct S3 path
-        audio_uuid = str(uuid.uuid4())  
-        s3_key = f"tts/{audio_uuid}.wav"
+            # Trim trailing silence/artifacts before encoding. Chatterbox
+            # returns the waveform already on the host, so the trim runs on
+            # CPU; trimming any earlier would mean patching inside the model.
+            wav = self._trim_trailing_silence(wav, self.model.sr)
+
+        return wav
+
+    def _apply_voice_prompt(self, voice_s3_key: str, exaggeration: float) -> None:
+        """
+        Point the model's voice conditioning at the given S3 voice prompt.
+
+        On the first request for a voice this reads the prompt from the S3
+        mount and runs the voice encoder, then caches the resulting
+        conditioning tensors keyed by (s3 key, file mtime) so repeat requests
+        skip both the I/O and the encoder forward. Exaggeration is applied by
+        generate() on top of the cached conditioning, so it is not part of
+        the cache key. The cache is evicted oldest-first once it reaches
+        VOICE_CACHE_MAX_ENTRIES.
+
+        Args:
+            voice_s3_key: S3 key of the voice sample to clone.
+            exaggeration: Emotional intensity used if the prompt is encoded fresh.
+
+        Raises:
+            FileNotFoundError: If the voice prompt file doesn't exist in S3.
+        """
+        audio_prompt_path = f"/s3-mount/{voice_s3_key}"
+
+        # A single FUSE stat both validates existence and supplies the
+        # cache-invalidation mtime; a separate exists() check would cost one
+        # more network round-trip on the S3 mount
+        try:
+            prompt_mtime = os.path.getmtime(audio_prompt_path)
+        except OSError as exc:
+            raise FileNotFoundError(
+                f"Prompt audio not found at {audio_prompt_path}") from exc
+
+        cache_key = (voice_s3_key, prompt_mtime)
+        conds = self._voice_conds.get(cache_key)
+
+        if conds is None:
+            self.model.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            conds = self.model.conds
+            if len(self._voice_conds) >= self.VOICE_CACHE_MAX_ENTRIES:
+                self._voice_conds.pop(next(iter(self._voice_conds)))
+            self._voice_conds[cache_key] = conds
+        else:
+            self.model.conds = conds
+
+    def _write_wav(self, path: str, wav_cpu: torch.Tensor, sample_rate: int) -> None:
+        """
+        Write a mono fp32 waveform to disk as a 16-bit PCM WAV file.
+
+        A WAV file is just the 44-byte RIFF header from _wav_header followed
+        by raw little-endian int16 samples, so writing it directly avoids the
+        sox/ffmpeg dispatch and extra conversion copy that torchaudio.save
+        goes through.
+
+        Args:
+            path: Destination file path.
+            wav_cpu: Audio tensor of shape (1, samples) or (samples,) on the CPU.
+            sample_rate: Audio sample rate in Hz.
+        """
+        pcm = (wav_cpu.reshape(-1).clamp(-1.0, 1.0) * 32767.0).to(torch.int16)
+        with open(path, "wb") as f:
+            f.write(self._wav_header(pcm.numel(), sample_rate))
+            pcm.numpy().tofile(f)
+
+    @staticmethod
+    def _wav_header(num_samples: int, sample_rate: int, num_channels: int = 1) -> bytes:
+        """
+        Build a 44-byte RIFF/WAVE header for 16-bit PCM audio.
+
+        Args:
+            num_samples: Number of samples per channel in the data payload.
+            sample_rate: Audio sample rate in Hz.
+            num_channels: Number of interleaved channels (mono by default).
+
+        Returns:
+            The packed header bytes, to be followed by raw little-endian
+            int16 sample data.
+        """
+        data_size = num_samples * num_channels * 2  # 2 bytes per int16 sample
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", 36 + data_size, b"WAVE",
+            b"fmt ", 16,                      # fmt chunk size
+            1,                                # PCM (uncompressed) format tag
+            num_channels, sample_rate,
+            sample_rate * num_channels * 2,   # byte rate
+            num_channels * 2, 16,             # block align, bits per sample
+            b"data", data_size,
+        )
 
-        # Write audio file to S3 via mounted bucket
-        s3_path = f"/s3-mount/{s3_key}" 
-        os.makedirs(os.path.dirname(s3_path), exist_ok=True)
-        with open(s3_path, "wb") as f:
-            f.write(audio_bytes)
-        
-        print(f"Saved audio to S3: {s3_key}")
-        return TextToSpeechResponse(s3_Key=s3_key)
-    
     def _trim_trailing_silence(self, wav: torch.Tensor, sample_rate: int, 
                                 threshold_db: float = -35.0, 
                                 min_silence_ms: int = 100,
@@ -248,17 +510,13 @@ class TextToSpeechServer:
         if num_frames <= 0:
             return wav
         
-        # Find the last frame with energy above threshold
-        last_voiced_frame = 0
-        for i in range(num_frames - 1, -1, -1):
-            start = i * hop_length
-            end = start + frame_length
-            frame = audio[start:end]
-            rms = torch.sqrt(torch.mean(frame ** 2)).item()
-            
-            if rms > threshold:
-                last_voiced_frame = i
-                break
+        # Find the last frame with energy above threshold. Frame extraction,
+        # RMS, and thresholding are done as a single vectorized pass — the
+        # previous per-frame Python loop paid a host sync per .item() call.
+        frames = audio.unfold(0, frame_length, hop_length)  # (num_frames, frame_length)
+        rms = frames.pow(2).mean(dim=1).sqrt_()
+        voiced = (rms > threshold).nonzero(as_tuple=False)
+        last_voiced_frame = int(voiced[-1]) if voiced.numel() > 0 else 0
         
         # Calculate trim point with a small buffer for natural decay
         min_silence_samples = int(sample_rate * min_silence_ms / 1000)